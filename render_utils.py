@@ -2,34 +2,77 @@
 
 import codecs
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 import json
 import logging
+import os
+import re
 import time
 import urllib
 import subprocess
 
 from flask import Markup, g, render_template, request
-from slimit import minify
-from smartypants import smartypants
 
 import app_config
-import copytext, copydoc
+import copytext
 
 logging.basicConfig(format=app_config.LOG_FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(app_config.LOG_LEVEL)
 
+# Parsed DOC, keyed by (path, mtime, size). See `_get_doc`.
+_DOC_CACHE = {}
+
+# Flattened app_config, keyed by deployment target. See `flatten_app_config`.
+_FLAT_CONFIG = {}
+
+# Relativized asset paths. See `_relativize`.
+_RELATIVE_PATHS = {}
+_RELATIVE_PATHS_MAX = 1024
+
+# smartypants output, keyed by input. See `_smartypants_cached`.
+_SMARTYPANTS = {}
+_SMARTYPANTS_MAX = 4096
+
+def json_default(obj):
+    """
+    `default` hook for json.dumps that intelligently handles datetimes.
+    """
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
 class BetterJSONEncoder(json.JSONEncoder):
     """
     A JSON encoder that intelligently handles datetimes.
+
+    Kept for backwards compatibility; prefer
+    `json.dumps(obj, default=json_default)`.
     """
     def default(self, obj):
-        if isinstance(obj, datetime):
-            encoded_object = obj.isoformat()
-        else:
-            encoded_object = json.JSONEncoder.default(self, obj)
+        return json_default(obj)
+
+def _relativize(path, request_path, asset_depth):
+    """
+    Make an asset path relative to the page at `request_path`.
+    Memoized, since every page pushes the same handful of assets.
+    """
+    key = (path, request_path, asset_depth)
+
+    if key not in _RELATIVE_PATHS:
+        relative_path = path
+        if relative_path.startswith('www/'):
+            relative_path = relative_path[4:]
+
+        depth = len(request_path.split('/')) - (2 + asset_depth)
+
+        if len(_RELATIVE_PATHS) >= _RELATIVE_PATHS_MAX:
+            _RELATIVE_PATHS.clear()
 
-        return encoded_object
+        _RELATIVE_PATHS[key] = '../' * depth + relative_path
+
+    return _RELATIVE_PATHS[key]
 
 class Includer(object):
     """
@@ -37,13 +80,19 @@ class Includer(object):
 
     See `make_context` for an explanation of `asset_depth`.
     """
+    __slots__ = ('includes', '_seen', 'tag_string', 'asset_depth')
+
     def __init__(self, asset_depth=0):
         self.includes = []
+        self._seen = set()
         self.tag_string = None
         self.asset_depth = asset_depth
 
     def push(self, path):
-        self.includes.append(path)
+        # Templates may push the same shared asset more than once
+        if path not in self._seen:
+            self._seen.add(path)
+            self.includes.append(path)
 
         return ''
 
@@ -51,17 +100,7 @@ class Includer(object):
         raise NotImplementedError()
 
     def _relativize_path(self, path):
-        relative_path = path
-        if relative_path.startswith('www/'):
-            relative_path = relative_path[4:]
-
-        depth = len(request.path.split('/')) - (2 + self.asset_depth)
-
-        while depth > 0:
-            relative_path = '../%s' % relative_path
-            depth -= 1
-
-        return relative_path
+        return _relativize(path, request.path, self.asset_depth)
 
     def render(self, path):
         if getattr(g, 'compile_includes', False):
@@ -84,15 +123,17 @@ class Includer(object):
 
             markup = Markup(self.tag_string % self._relativize_path(timestamp_path))
         else:
-            response = ','.join(self.includes)
+            tag_string = self.tag_string
+            relativize_path = self._relativize_path
 
             response = '\n'.join([
-                self.tag_string % self._relativize_path(src) for src in self.includes
+                tag_string % relativize_path(src) for src in self.includes
             ])
 
             markup = Markup(response)
 
         del self.includes[:]
+        self._seen.clear()
 
         return markup
 
@@ -100,54 +141,57 @@ class JavascriptIncluder(Includer):
     """
     Psuedo-template tag that handles collecting Javascript and serving appropriate clean or compressed versions.
     """
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         Includer.__init__(self, *args, **kwargs)
 
         self.tag_string = '<script type="text/javascript" src="%s"></script>'
 
     def _compress(self):
-        output = []
         src_paths = []
 
         for src in self.includes:
             src_paths.append('www/%s' % src)
+            logger.info('- compressing %s' % src)
 
-            with codecs.open('www/%s' % src, encoding='utf-8') as f:
-                logger.info('- compressing %s' % src)
-                output.append(minify(f.read()))
+        try:
+            compressed_src = subprocess.check_output(["node_modules/uglify-js/bin/uglifyjs"] + src_paths + ["-c", "-m"])
+        except:
+            logger.error('It looks like "uglifyjs" isn\'t installed. Try running: "npm install"')
+            raise
 
         context = make_context()
         context['paths'] = src_paths
 
         header = render_template('_js_header.js', **context)
-        output.insert(0, header)
 
-        return '\n'.join(output)
+        return '\n'.join([header, compressed_src.decode('utf-8')])
 
 class CSSIncluder(Includer):
     """
     Psuedo-template tag that handles collecting CSS and serving appropriate clean or compressed versions.
     """
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         Includer.__init__(self, *args, **kwargs)
 
         self.tag_string = '<link rel="stylesheet" type="text/css" href="%s" />'
 
     def _compress(self):
-        output = []
+        src_paths = list(self.includes)
 
-        src_paths = []
-
-        for src in self.includes:
+        # Each lessc run pays Node's startup cost, so run them side by side
+        pool = ThreadPool(len(src_paths) or 1)
 
-            src_paths.append('%s' % src)
-
-            try:
-                compressed_src = subprocess.check_output(["node_modules/less/bin/lessc", "-x", src])
-                output.append(compressed_src)
-            except:
-                logger.error('It looks like "lessc" isn\'t installed. Try running: "npm install"')
-                raise
+        try:
+            output = pool.map(_lessc, src_paths)
+        except:
+            logger.error('It looks like "lessc" isn\'t installed. Try running: "npm install"')
+            raise
+        finally:
+            pool.close()
 
         context = make_context()
         context['paths'] = src_paths
@@ -158,19 +202,123 @@ class CSSIncluder(Includer):
 
         return '\n'.join(output)
 
+def _lessc(src):
+    """
+    Compress a single LESS/CSS file with lessc.
+    """
+    return subprocess.check_output(["node_modules/less/bin/lessc", "-x", src])
+
 def flatten_app_config():
     """
     Returns a copy of app_config containing only
     configuration variables.
+
+    The result is computed once per deployment target, since
+    `configure_targets` is the only thing that changes it.
+    """
+    target = app_config.DEPLOYMENT_TARGET
+
+    if target not in _FLAT_CONFIG:
+        # Only all-caps [constant] vars get included
+        _FLAT_CONFIG[target] = {
+            k: v for k, v in app_config.__dict__.items() if k.isupper()
+        }
+
+    return _FLAT_CONFIG[target].copy()
+
+# Copydoc header tokens, mapped to CopyDoc attribute names
+_COPYDOC_TOKENS = (
+  ('TITLE', 'title'),
+  ('TEASER', 'teaser'),
+  ('BYLINE', 'byline'),
+  ('SUBHED', 'subhed'),
+)
+
+# Classifies a story-body sibling by its text. Embeds are raw markup,
+# passed through as-is; -30- ends the story.
+_SIBLING_RE = re.compile(
+    r'(?P<end>-30-\Z)'
+    r'|(?P<embed><iframe|<p data|<hr|<img)'
+    r'|(?P<document>DOCUMENT:)'
+    r'|(?P<caption>CAPTION:)'
+)
+
+def _is_text_marker(tag):
+    """
+    Matches the `TEXT:` paragraph that opens the story body.
+    """
+    return tag.name == 'p' and tag.text.startswith('TEXT:')
+
+def _parse_doc():
+    """
+    Parse DOC_PATH into a CopyDoc and split the story body
+    into `text` and `text_list`.
+    """
+    import copydoc
+
+    with open(app_config.DOC_PATH, 'rb') as f:
+        html = f.read()
+
+    doc = copydoc.CopyDoc(html, _COPYDOC_TOKENS)
+    soup = doc.soup
+
+    dict_template = {'template':'main','text':'','class':''}
+    text_parts = []
+
+    for tag in soup.findAll(_is_text_marker):
+        for sib in tag.next_siblings:
+            dict_copy = dict_template.copy()
+            text = sib.text
+            match = _SIBLING_RE.match(text)
+            kind = match.lastgroup if match else None
+
+            if kind == 'end':
+                break
+            elif kind == 'embed':
+                text_parts.append(text)
+                dict_copy['text'] = text
+                dict_copy['class'] = 'col-sm-10 col-sm-offset-1'
+                doc.text_list.append(dict_copy)
+            elif kind == 'document':
+                link = sib.a
+                link_text = link.text
+
+                if 'Plan' in link_text:
+                    i = 'document'
+                else:
+                    i = 'contract'
+                s = '<p class="document image"><a href="%s" >%s<br><img class="img-rounded" src="https://s3.amazonaws.com/wbez-assets/WBEZ-Graphics/snow-tows/%s.jpg" /></a></p>' % (link['href'][0], link_text,i)
+                dict_copy['text'] = s
+                # self.text_list[-1]['text']+=s
+                # self.text_list[-1]['class'] += 'col-sm-8 col-sm-offset-2 document'
+                doc.text_list.append(dict_copy)
+            elif kind == 'caption':
+                dict_copy['text'] = unicode(sib).replace('CAPTION: ','')
+                dict_copy['class'] = 'col-sm-8 col-sm-offset-2 caption'
+                doc.text_list.append(dict_copy)
+            else:
+                html = unicode(sib)
+                text_parts.append(html)
+                dict_copy['text'] = html
+                doc.text_list.append(dict_copy)
+
+    doc.text += ''.join(text_parts)
+
+    return doc
+
+def _get_doc():
+    """
+    Return the parsed DOC, reparsing only when DOC_PATH changes on disk.
     """
-    config = {}
+    # mtime alone can miss two writes within the same second
+    st = os.stat(app_config.DOC_PATH)
+    key = (app_config.DOC_PATH, st.st_mtime, st.st_size)
 
-    # Only all-caps [constant] vars get included
-    for k, v in app_config.__dict__.items():
-        if k.upper() == k:
-            config[k] = v
+    if key not in _DOC_CACHE:
+        _DOC_CACHE.clear()
+        _DOC_CACHE[key] = _parse_doc()
 
-    return config
+    return _DOC_CACHE[key]
 
 def make_context(asset_depth=0):
     """
@@ -188,56 +336,7 @@ def make_context(asset_depth=0):
     except copytext.CopyException:
         pass
 
-    with open(app_config.DOC_PATH) as f:
-        html = f.read()
-
-    tokens = (
-      ('TITLE', 'title'),
-      ('TEASER', 'teaser'),
-      ('BYLINE', 'byline'),
-      ('SUBHED', 'subhed'),
-    )
-
-    doc = copydoc.CopyDoc(html,tokens)
-    context['DOC'] = doc
-    soup = doc.soup
-
-    dict_template = {'template':'main','text':'','class':''}
-
-    for tag in soup.findAll('p'):
-        if tag.text.startswith('TEXT:'):
-            
-            for sib in tag.next_siblings:
-                dict_copy = dict_template.copy()
-                if sib.text == "-30-":
-                    break
-                elif (sib.text.startswith('<iframe')) | (sib.text.startswith('<p data')) | (sib.text.startswith('<hr')) | (sib.text.startswith('<img')):
-                    doc.text += sib.text
-                    dict_copy['text'] = sib.text
-                    dict_copy['class'] = 'col-sm-10 col-sm-offset-1'
-                    doc.text_list.append(dict_copy)
-                elif (sib.text.startswith('DOCUMENT:')):
-                    t = sib.text.replace('DOCUMENT: ','')
-                    
-                    if 'Plan' in sib.a.text:
-                        i = 'document'
-                    else:
-                        i = 'contract'
-                    s = '<p class="document image"><a href="%s" >%s<br><img class="img-rounded" src="https://s3.amazonaws.com/wbez-assets/WBEZ-Graphics/snow-tows/%s.jpg" /></a></p>' % (sib.a['href'][0], sib.a.text,i)
-                    dict_copy['text'] = s
-                    # self.text_list[-1]['text']+=s
-                    # self.text_list[-1]['class'] += 'col-sm-8 col-sm-offset-2 document'
-                    doc.text_list.append(dict_copy)
-                elif (sib.text.startswith('CAPTION:')):
-                    t = unicode(sib)
-                    t = t.replace('CAPTION: ','')
-                    dict_copy['text'] = t
-                    dict_copy['class'] = 'col-sm-8 col-sm-offset-2 caption'
-                    doc.text_list.append(dict_copy)
-                else:
-                    doc.text += unicode(sib)
-                    dict_copy['text'] = unicode(sib)
-                    doc.text_list.append(dict_copy)
+    context['DOC'] = _get_doc()
 
     context['JS'] = JavascriptIncluder(asset_depth=asset_depth)
     context['CSS'] = CSSIncluder(asset_depth=asset_depth)
@@ -248,32 +347,47 @@ def urlencode_filter(s):
     """
     Filter to urlencode strings.
     """
-    if type(s) == 'Markup':
+    if isinstance(s, Markup):
         s = s.unescape()
 
     # Evaulate COPY elements
-    if type(s) is not unicode:
+    if not isinstance(s, basestring):
         s = unicode(s)
 
-    s = s.encode('utf8')
+    if isinstance(s, unicode):
+        s = s.encode('utf8')
+
     s = urllib.quote_plus(s)
 
     return Markup(s)
 
+def _smartypants_cached(s):
+    """
+    Memoized smartypants. COPY and DOC strings repeat across every render.
+    """
+    if s not in _SMARTYPANTS:
+        if len(_SMARTYPANTS) >= _SMARTYPANTS_MAX:
+            _SMARTYPANTS.clear()
+
+        from smartypants import smartypants
+
+        _SMARTYPANTS[s] = smartypants(s)
+
+    return _SMARTYPANTS[s]
+
 def smarty_filter(s):
     """
     Filter to smartypants strings.
     """
-    if type(s) == 'Markup':
-        s = s.unescape()
-
-    # Evaulate COPY elements
-    if type(s) is not unicode:
+    # Evaulate COPY elements. Markup is already unicode and stays
+    # escaped; smartypants leaves HTML entities alone.
+    if not isinstance(s, basestring):
         s = unicode(s)
 
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
 
-    s = s.encode('utf-8')
-    s = smartypants(s)
+    s = _smartypants_cached(s)
 
     try:
         return Markup(s)
@@ -10,7 +10,7 @@ from flask import abort, make_response
 import app_config
 import copytext
 from flask import Blueprint
-from render_utils import BetterJSONEncoder, flatten_app_config
+from render_utils import flatten_app_config, json_default
 
 static = Blueprint('static', __name__)
 
@@ -35,7 +35,7 @@ def _less(filename):
 @static.route('/js/app_config.js')
 def _app_config_js():
     config = flatten_app_config()
-    js = 'window.APP_CONFIG = ' + json.dumps(config, cls=BetterJSONEncoder)
+    js = 'window.APP_CONFIG = ' + json.dumps(config, default=json_default)
 
     return make_response(js, 200, { 'Content-Type': 'application/javascript' })
 
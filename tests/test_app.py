@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
 import json
+import os
 import unittest
 
+from flask import Markup
+
 import app
 import app_config
+import render_utils
 
 class IndexTestCase(unittest.TestCase):
     """
@@ -51,5 +55,92 @@ class AppConfigTestCase(unittest.TestCase):
         
         app_config.configure_targets('staging')
 
+class DocCacheTestCase(unittest.TestCase):
+    """
+    Test that the parsed DOC is reused until the file changes.
+    """
+    def test_doc_cached_until_modified(self):
+        doc = render_utils.make_context()['DOC']
+
+        assert render_utils.make_context()['DOC'] is doc
+
+        st = os.stat(app_config.DOC_PATH)
+
+        try:
+            os.utime(app_config.DOC_PATH, (st.st_atime, st.st_mtime + 10))
+
+            assert render_utils.make_context()['DOC'] is not doc
+        finally:
+            os.utime(app_config.DOC_PATH, (st.st_atime, st.st_mtime))
+
+class IncluderTestCase(unittest.TestCase):
+    """
+    Test de-duplication of pushed include paths.
+    """
+    def test_push_dedupes_paths(self):
+        with app.app.test_request_context('/'):
+            js = render_utils.JavascriptIncluder()
+
+            js.push('js/app.js')
+            js.push('js/app.js')
+            markup = js.render('js/app-footer.min.js')
+
+            assert markup.count('js/app.js') == 1
+            assert not js._seen
+
+            js.push('js/app.js')
+            markup = js.render('js/app-footer.min.js')
+
+            assert markup.count('js/app.js') == 1
+
+class SiblingClassifierTestCase(unittest.TestCase):
+    """
+    Test classification of story-body siblings in the DOC.
+    """
+    def kind(self, text):
+        match = render_utils._SIBLING_RE.match(text)
+
+        return match.lastgroup if match else None
+
+    def test_end_marker(self):
+        assert self.kind(u'-30-') == 'end'
+
+    def test_end_marker_exact(self):
+        assert self.kind(u'-30- ') is None
+        assert self.kind(u'-30-\n') is None
+
+    def test_embeds(self):
+        for text in [u'<iframe src="x">', u'<p data-x="y">', u'<hr>', u'<img src="x">']:
+            assert self.kind(text) == 'embed'
+
+    def test_document(self):
+        assert self.kind(u'DOCUMENT: Plan') == 'document'
+
+    def test_caption(self):
+        assert self.kind(u'CAPTION: A tow truck') == 'caption'
+
+    def test_plain_text(self):
+        assert self.kind(u'The city towed 100 cars.') is None
+
+class FilterTestCase(unittest.TestCase):
+    """
+    Test the urlencode and smarty template filters.
+    """
+    def test_urlencode_unescapes_markup(self):
+        s = render_utils.urlencode_filter(Markup(u'a &amp; b'))
+
+        assert s == 'a+%26+b'
+
+    def test_urlencode_bytes(self):
+        s = render_utils.urlencode_filter('caf\xc3\xa9')
+
+        assert s == 'caf%C3%A9'
+
+    def test_smarty_keeps_markup_escaped(self):
+        s = render_utils.smarty_filter(Markup(u'&lt;script&gt;'))
+
+        assert '&lt;script&gt;' in s
+        assert '<script>' not in s
+
 if __name__ == '__main__':
     unittest.main()